@@ -1,16 +1,19 @@
 from __future__ import annotations
 
+import asyncio
 import os
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, TypedDict
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TypedDict
 
 import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
 # 1. Initialize the FastAPI app FIRST
-app = FastAPI(title="Wellness Navigator AI")
+app = FastAPI(title="Wellness Navigator AI", default_response_class=ORJSONResponse)
 
 # 2. Add Middleware IMMEDIATELY after initializing app
 app.add_middleware(
@@ -31,11 +34,6 @@ except Exception:
     Client = None
     create_client = None
 
-try:
-    from langgraph.graph import END, StateGraph, START
-except Exception as exc:
-    raise RuntimeError("LangGraph is required. Install with `pip install langgraph`.") from exc
-
 # --- Models ---
 class CoachRequest(BaseModel):
     user_name: str
@@ -67,86 +65,144 @@ class CoachState(TypedDict, total=False):
     activity_level: Optional[str]
     primary_metric: Optional[str]
     focus_area: Optional[str]
+    intent: Optional[str]
     next_question: Optional[str]
     missing_field: Optional[str]
     ready_to_sync: bool
-    recommended_actions: List[str]
+    recommended_actions: Sequence[str]
     safety_flag: Optional[str]
 
 # --- Constants & Clients ---
-SAFETY_KEYWORDS = {"chest pain", "shortness of breath", "suicidal", "faint", "fainted"}
-FITNESS_KEYWORDS = {"workout", "steps", "muscle", "run", "cardio", "strength"}
-NUTRITION_KEYWORDS = {"calories", "meal", "water", "protein", "fiber", "hydration"}
-RESILIENCE_KEYWORDS = {"anxiety", "sleep", "meditation", "stress", "burnout"}
+SAFETY_KEYWORDS = frozenset({"chest pain", "shortness of breath", "suicidal", "faint", "fainted"})
+FITNESS_KEYWORDS = frozenset({"workout", "steps", "muscle", "run", "cardio", "strength"})
+NUTRITION_KEYWORDS = frozenset({"calories", "meal", "water", "protein", "fiber", "hydration"})
+RESILIENCE_KEYWORDS = frozenset({"anxiety", "sleep", "meditation", "stress", "burnout"})
+
+CLARIFICATION_PROMPTS = {
+    "goal": "What's your primary wellness goal right now?",
+    "activity_level": "How active have you been this week?",
+    "primary_metric": "What metric should we track? (e.g., steps, sleep hours)",
+}
+# Tuples so the shared defaults can be handed out without copying.
+RECOMMENDATIONS = {
+    "fitness": ("Plan 3-4 sessions this week.", "Log steps daily."),
+    "nutrition": ("Aim for protein in each meal.", "Hydrate steadily."),
+    "resilience": ("Schedule a sleep window.", "Add a 5-min breathing break."),
+}
 
 WEBHOOK_URL = os.getenv("WELLNESS_WEBHOOK_URL", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 
+SUPABASE_BATCH_SIZE = int(os.getenv("SUPABASE_BATCH_SIZE", "100"))
+SUPABASE_FLUSH_INTERVAL = float(os.getenv("SUPABASE_FLUSH_INTERVAL", "1.0"))
+SUPABASE_QUEUE_SIZE = int(os.getenv("SUPABASE_QUEUE_SIZE", "10000"))
+SUPABASE_SHUTDOWN_TIMEOUT = float(os.getenv("SUPABASE_SHUTDOWN_TIMEOUT", "10.0"))
+
 supabase_client: Optional[Client] = None
 if SUPABASE_URL and SUPABASE_KEY and create_client:
     supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Pending health_logs rows; a None entry tells the flusher to drain and stop.
+# Both are created on startup so the queue belongs to the serving event loop.
+_log_queue: Optional["asyncio.Queue[Optional[Dict[str, Any]]]"] = None
+_flusher_task: Optional["asyncio.Task[None]"] = None
+
 # --- Logic Functions ---
-def classify_intent(message: str) -> str:
-    lowered = message.lower()
+# Both helpers take the message already lower-cased (see start_node).
+def classify_intent(lowered: str) -> str:
     if any(k in lowered for k in FITNESS_KEYWORDS): return "fitness"
     if any(k in lowered for k in NUTRITION_KEYWORDS): return "nutrition"
     if any(k in lowered for k in RESILIENCE_KEYWORDS): return "resilience"
     return "fitness"
 
-def detect_safety(message: str) -> Optional[str]:
-    lowered = message.lower()
-    for word in SAFETY_KEYWORDS:
-        if word in lowered:
-            return "Possible distress detected. Please contact emergency services immediately."
+def detect_safety(lowered: str) -> Optional[str]:
+    if any(k in lowered for k in SAFETY_KEYWORDS):
+        return "Possible distress detected. Please contact emergency services immediately."
     return None
 
 def missing_field(state: CoachState) -> Optional[str]:
-    for field in ("goal", "activity_level", "primary_metric"):
-        if not state.get(field): return field
+    if not state.get("goal"): return "goal"
+    if not state.get("activity_level"): return "activity_level"
+    if not state.get("primary_metric"): return "primary_metric"
     return None
 
 def clarification_prompt(field: str) -> str:
-    prompts = {
-        "goal": "What's your primary wellness goal right now?",
-        "activity_level": "How active have you been this week?",
-        "primary_metric": "What metric should we track? (e.g., steps, sleep hours)",
-    }
-    return prompts.get(field, "Could you share more detail?")
+    return CLARIFICATION_PROMPTS.get(field, "Could you share more detail?")
 
-def recommendations_for_focus(focus: str) -> List[str]:
-    recs = {
-        "fitness": ["Plan 3-4 sessions this week.", "Log steps daily."],
-        "nutrition": ["Aim for protein in each meal.", "Hydrate steadily."],
-        "resilience": ["Schedule a sleep window.", "Add a 5-min breathing break."]
-    }
-    return recs.get(focus, recs["fitness"])
+def recommendations_for_focus(focus: str) -> Tuple[str, ...]:
+    return RECOMMENDATIONS.get(focus, RECOMMENDATIONS["fitness"])
+
+def _now_iso() -> str:
+    # Same shape as datetime.now(timezone.utc).isoformat(), without building a datetime.
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))}.{nanos // 1000:06d}+00:00"
 
 def log_to_supabase(state: CoachState) -> None:
-    if not supabase_client: return
+    # Must be called from the event loop thread; rows are written in batches
+    # by _supabase_flusher. Rows are dropped when no flusher is running or the
+    # queue is full (e.g. PostgREST stalled), rather than growing memory.
+    if not supabase_client or _log_queue is None: return
     payload = {
         "user_name": state.get("user_name"),
         "focus_area": state.get("focus_area"),
         "primary_goal": state.get("goal"),
         "activity_level": state.get("activity_level"),
         "health_metric": state.get("primary_metric"),
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": _now_iso(),
     }
     try:
-        supabase_client.table("health_logs").insert(payload).execute()
+        _log_queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        return
+
+def _insert_health_logs(rows: List[Dict[str, Any]]) -> None:
+    try:
+        supabase_client.table("health_logs").insert(rows).execute()
     except:
         return
 
-# --- Graph Nodes ---
+async def _supabase_flusher(queue: "asyncio.Queue[Optional[Dict[str, Any]]]") -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await queue.get()
+        if payload is None: return
+        batch = [payload]
+        deadline = loop.time() + SUPABASE_FLUSH_INTERVAL
+        stop = False
+        while len(batch) < SUPABASE_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try:
+                payload = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if payload is None:
+                stop = True
+                break
+            batch.append(payload)
+        await asyncio.to_thread(_insert_health_logs, batch)
+        if stop: return
+
+async def _drain_flusher(
+    queue: "asyncio.Queue[Optional[Dict[str, Any]]]", task: "asyncio.Task[None]"
+) -> None:
+    await queue.put(None)
+    await task
+
+# --- Coach Nodes ---
+# Plain sync functions on purpose: /coach runs them on the event loop, so they
+# must stay pure CPU. Any I/O belongs in the route (see log_to_supabase).
 def start_node(state: CoachState) -> CoachState:
-    state["safety_flag"] = detect_safety(state.get("message", ""))
+    lowered = state.get("message", "").lower()
+    state["safety_flag"] = detect_safety(lowered)
+    state["intent"] = classify_intent(lowered)
     state["ready_to_sync"] = False
     return state
 
 def intent_classifier_node(state: CoachState) -> CoachState:
     if not state.get("focus_area"):
-        state["focus_area"] = classify_intent(state.get("message", ""))
+        state["focus_area"] = state.get("intent") or "fitness"
     return state
 
 def wellness_node(state: CoachState) -> CoachState:
@@ -159,29 +215,88 @@ def wellness_node(state: CoachState) -> CoachState:
     else:
         state["next_question"] = None
         state["ready_to_sync"] = True
-        log_to_supabase(state)
     return state
 
-def router(state: CoachState) -> str:
-    focus = state.get("focus_area") or "fitness"
-    return f"{focus}_node"
+def run_coach(state: CoachState) -> CoachState:
+    """Run the coach nodes in order: safety scan, intent, wellness.
+
+    A distress message stops after ``start_node``; everything else runs the
+    full linear flow.
+    """
+    state = start_node(state)
+    if state.get("safety_flag"):
+        return state
+    return wellness_node(intent_classifier_node(state))
 
-# --- Build LangGraph ---
-workflow = StateGraph(CoachState)
-workflow.add_node("initial_node", start_node)
-workflow.add_node("intent_classifier_node", intent_classifier_node)
-workflow.add_node("fitness_node", wellness_node)
-workflow.add_node("nutrition_node", wellness_node)
-workflow.add_node("resilience_node", wellness_node)
+CoachOutcome = Tuple[str, bool, Optional[str], Optional[str], Tuple[str, ...], Optional[str]]
 
-workflow.add_edge(START, "initial_node")
-workflow.add_edge("initial_node", "intent_classifier_node")
-workflow.add_conditional_edges("intent_classifier_node", router)
-workflow.add_edge("fitness_node", END)
-workflow.add_edge("nutrition_node", END)
-workflow.add_edge("resilience_node", END)
+# The nodes are deterministic and side-effect free (logging happens in the
+# route), so identical check-ins can reuse the previous outcome. user_name is
+# left out of the key because it never affects the response. Every key field
+# is a client string, so a call is only cached when their combined length
+# fits CACHEABLE_KEY_LENGTH; that bounds the cache to roughly
+# maxsize * CACHEABLE_KEY_LENGTH characters.
+CACHEABLE_KEY_LENGTH = 512
 
-coach_executor = workflow.compile()
+def _coach_outcome(
+    message: str,
+    goal: Optional[str],
+    activity_level: Optional[str],
+    primary_metric: Optional[str],
+    focus_area: Optional[str],
+) -> CoachOutcome:
+    result = run_coach({
+        "message": message,
+        "goal": goal,
+        "activity_level": activity_level,
+        "primary_metric": primary_metric,
+        "focus_area": focus_area,
+    })
+    return (
+        result.get("focus_area") or result.get("intent") or "fitness",
+        result.get("ready_to_sync", False),
+        result.get("missing_field"),
+        result.get("next_question"),
+        tuple(result.get("recommended_actions", ())),
+        result.get("safety_flag"),
+    )
+
+_cached_coach_outcome = lru_cache(maxsize=4096)(_coach_outcome)
+
+def coach_outcome(
+    message: str,
+    goal: Optional[str],
+    activity_level: Optional[str],
+    primary_metric: Optional[str],
+    focus_area: Optional[str],
+) -> CoachOutcome:
+    key_length = len(message) + sum(
+        len(field) for field in (goal, activity_level, primary_metric, focus_area) if field
+    )
+    if key_length > CACHEABLE_KEY_LENGTH:
+        return _coach_outcome(message, goal, activity_level, primary_metric, focus_area)
+    return _cached_coach_outcome(message, goal, activity_level, primary_metric, focus_area)
+
+# --- Lifecycle ---
+@app.on_event("startup")
+async def start_supabase_flusher():
+    global _log_queue, _flusher_task
+    if supabase_client:
+        _log_queue = asyncio.Queue(maxsize=SUPABASE_QUEUE_SIZE)
+        _flusher_task = asyncio.create_task(_supabase_flusher(_log_queue))
+
+@app.on_event("shutdown")
+async def stop_supabase_flusher():
+    global _log_queue, _flusher_task
+    if _flusher_task:
+        queue, task = _log_queue, _flusher_task
+        # Stop accepting rows, then let the flusher write what is pending.
+        _log_queue, _flusher_task = None, None
+        try:
+            await asyncio.wait_for(_drain_flusher(queue, task), SUPABASE_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            # PostgREST is stalled; give up on the pending rows.
+            task.cancel()
 
 # --- API Routes ---
 @app.get("/health")
@@ -190,24 +305,32 @@ async def health_check():
 
 @app.post("/coach", response_model=CoachResponse)
 async def coach(request: CoachRequest):
-    state: CoachState = {
-        "user_name": request.user_name,
-        "message": request.message,
-        "goal": request.goal,
-        "activity_level": request.activity_level,
-        "primary_metric": request.primary_metric,
-        "focus_area": request.focus_area,
-    }
-    result = coach_executor.invoke(state)
-    
-    return CoachResponse(
-        focus_area=result.get("focus_area", "fitness"),
-        ready_to_sync=result.get("ready_to_sync", False),
-        missing_field=result.get("missing_field"),
-        next_question=result.get("next_question"),
-        recommended_actions=result.get("recommended_actions", []),
-        safety_flag=result.get("safety_flag"),
+    focus_area, ready_to_sync, missing, next_question, actions, safety_flag = coach_outcome(
+        request.message,
+        request.goal,
+        request.activity_level,
+        request.primary_metric,
+        request.focus_area,
     )
+    if ready_to_sync:
+        log_to_supabase({
+            "user_name": request.user_name,
+            "focus_area": focus_area,
+            "goal": request.goal,
+            "activity_level": request.activity_level,
+            "primary_metric": request.primary_metric,
+        })
+
+    # Every field is produced by our own code, so skip response_model
+    # validation and encoding; the model still documents the schema.
+    return ORJSONResponse({
+        "focus_area": focus_area,
+        "ready_to_sync": ready_to_sync,
+        "missing_field": missing,
+        "next_question": next_question,
+        "recommended_actions": actions,
+        "safety_flag": safety_flag,
+    })
 
 if __name__ == "__main__":
     import uvicorn